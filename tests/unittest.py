@@ -103,6 +103,1161 @@ class TestSync(unittest.TestCase):
         self.assertEqual(keyequal, [((2, 'l2'), (2, 'r2')),
                                     ((5, 'l5'), (5, 'r5'))])
 
+class TestParallel(unittest.TestCase):
+    def test_order(self):
+        import time
+        def slow(x):
+            time.sleep(0.01 * (5 - x))
+            return x * 2
+        self.assertEqual(mrepo.parallel(slow, range(5), jobs=3), [0, 2, 4, 6, 8])
+
+    def test_serial(self):
+        self.assertEqual(mrepo.parallel(str, (1, 2), jobs=1), ['1', '2'])
+
+class TestGenerate(unittest.TestCase):
+    class FakeDist:
+        def __init__(self, nick, repos):
+            self.nick = self.name = nick
+            self.repos = repos
+            self.log = []
+        def listrepos(self, names=None):
+            return self.repos
+        def genrepo(self, repo):
+            self.log.append(repo)
+            return [repo + '-src']
+        def genall(self, allsrcdirs):
+            self.log.append(('all', allsrcdirs))
+            return True
+
+    def test_allafterrepos(self):
+        dists = [self.FakeDist('a', ['os', 'updates']), self.FakeDist('b', ['extras']), self.FakeDist('c', [])]
+        mrepo.generate(dists, jobs=4)
+        self.assertEqual(sorted(dists[0].log[:2]), ['os', 'updates'])
+        self.assertEqual(dists[0].log[2], ('all', [['os-src'], ['updates-src']]))
+        self.assertEqual(dists[1].log, ['extras', ('all', [['extras-src']])])
+        self.assertEqual(dists[2].log, [('all', [])])
+
+def _rpmheader(il=0, data=b''):
+    "Return a header structure with il empty index entries"
+    import struct
+    return b'\x8e\xad\xe8\x01\0\0\0\0' + struct.pack('>II', il, len(data)) + b'\0' * 16 * il + data
+
+def _rpmheadertags(tags):
+    "Return a header structure with index entries for a list of (tag, type, count, data)"
+    import struct
+    index = b''
+    store = b''
+    for tag, type, count, data in tags:
+        index += struct.pack('>IIiI', tag, type, len(store), count)
+        store += data
+    return b'\x8e\xad\xe8\x01\0\0\0\0' + struct.pack('>II', len(tags), len(store)) + index + store
+
+def _rpmfile(tags):
+    "Return an RPM file with an empty signature, a header with a list of (tag, type, count, data) and a payload"
+    return b'\xed\xab\xee\xdb' + b'\0' * 92 + _rpmheader() + _rpmheadertags(tags) + b'payload'
+
+class TestMrepomd(unittest.TestCase):
+    def test_headerrange(self):
+        sig = _rpmheader(1, b'abc')
+        sig = sig + b'\0' * (8 - len(sig) % 8)
+        hdr = _rpmheader(2, b'0123456789')
+        rpmfile = b'\xed\xab\xee\xdb' + b'\0' * 92 + sig + hdr + b'payload'
+        start = 96 + len(sig)
+        self.assertEqual(mrepo.rpmheaderrange(rpmfile), (start, start + len(hdr)))
+
+    def test_headerrange_notrpm(self):
+        self.assertRaises(ValueError, mrepo.rpmheaderrange, b'\0' * 200)
+
+    def test_readheader(self):
+        import struct
+        hdr = _rpmheadertags([(1000, 6, 1, b'foo\0'), (1001, 6, 1, b'1.0\0'), (1002, 6, 1, b'2.el5\0'),
+                              (1003, 4, 1, struct.pack('>I', 0)), (1022, 6, 1, b'x86_64\0'),
+                              (1004, 9, 2, b'Summary\0Zusammenfassung\0'),
+                              (1047, 8, 2, b'foo\0libfoo.so.1()(64bit)\0'), (1112, 4, 2, struct.pack('>II', 8, 0)),
+                              (1030, 3, 2, struct.pack('>HH', 0o100644, 0o40755))])
+        buf = b'\0' * 8 + hdr + b'payload'
+        ret = mrepo.readheader(buf, 8, 8 + len(hdr))
+        self.assertEqual([ret[tag] for tag in ('name', 'epoch', 'version', 'release', 'arch')],
+                         ['foo', 0, '1.0', '2.el5', 'x86_64'])
+        self.assertEqual(ret['summary'], 'Summary')
+        self.assertEqual(ret['providename'], ['foo', 'libfoo.so.1()(64bit)'])
+        self.assertEqual(ret['provideflags'], [8, 0])
+        self.assertEqual(ret['filemodes'], [0o100644, 0o40755])
+        self.assertEqual(ret['sourcepackage'], None)
+        self.assertEqual(ret['requirename'], [])
+        self.assertEqual(mrepo.readheader(buf, 8, 8 + len(hdr), ('name', 'arch')), {'name': 'foo', 'arch': 'x86_64'})
+
+    def test_readheader_bad(self):
+        for tag, entry in (('name', (1000, 6, 1, b'foo')), ('providename', (1047, 8, 3, b'a\0b\0')),
+                           ('provideflags', (1112, 4, 2, b'\0\0\0\1'))):
+            hdr = _rpmheadertags([entry])
+            self.assertRaises(ValueError, mrepo.readheader, hdr, 0, len(hdr), (tag,))
+        self.assertRaises(ValueError, mrepo.readheader, hdr, 0, len(hdr) - 1)
+
+    def test_pkgcache(self):
+        import tempfile
+        tmpdir = tempfile.mkdtemp()
+        files = []
+        for name in ('foo', 'bar'):
+            files.append(os.path.join(tmpdir, name + '.rpm'))
+            open(files[-1], 'wb').write(_rpmfile([(1000, 6, 1, name.encode() + b'\0')]))
+        size = mrepo.pkgcachesize
+        mrepo.pkgcachesize = 1
+        try:
+            mrepo.pkgcache.clear()
+            for file in files:
+                mrepo.readpackage(file)
+            ### Only the most recently used package is kept
+            self.assertEqual(list(mrepo.pkgcache), [mrepo.statkey(os.stat(files[1]))])
+            ### With a package index, nothing is kept in memory
+            mrepo.pkgcache.clear()
+            mrepo.pkgindex = mrepo.PackageIndex(os.path.join(tmpdir, 'packages.db'))
+            self.assertEqual(mrepo.readpackage(files[0]).name, 'foo')
+            self.assertEqual(mrepo.readpackage(files[0]).name, 'foo')
+            self.assertEqual(len(mrepo.pkgcache), 0)
+        finally:
+            mrepo.pkgindex = None
+            mrepo.pkgcachesize = size
+            import shutil
+            shutil.rmtree(tmpdir)
+
+    def test_metadata(self):
+        import gzip, hashlib, shutil, struct, tempfile, xml.etree.ElementTree
+        tmpdir = tempfile.mkdtemp()
+        class TestConfig:
+            srcdir = os.path.join(tmpdir, 'src')
+            wwwdir = os.path.join(tmpdir, 'www')
+        cf = getattr(mrepo, 'cf', None)
+        mrepo.cf = TestConfig()
+        try:
+            dist = mrepo.Dist('test', 'x86_64', mrepo.cf)
+            repo = mrepo.Repo('os', '', dist, mrepo.cf)
+            os.makedirs(repo.wwwdir)
+            files = {}
+            files['foo-1.0-2.x86_64.rpm'] = _rpmfile([
+                (1000, 6, 1, b'foo\0'), (1001, 6, 1, b'1.0\0'), (1002, 6, 1, b'2\0'), (1003, 4, 1, struct.pack('>I', 3)),
+                (1004, 9, 1, b'The foo tool\0'), (1022, 6, 1, b'x86_64\0'),
+                (1030, 3, 3, struct.pack('>HHH', 0o40755, 0o100755, 0o100644)), (1037, 4, 3, struct.pack('>III', 0, 0, 0)),
+                (1080, 4, 1, struct.pack('>I', 1577836800)), (1081, 8, 1, b'Jan <jan@example.com> - 3:1.0-2\0'),
+                (1082, 8, 1, b'- Fix <bar> & baz\0'), (1116, 4, 3, struct.pack('>III', 0, 1, 2)),
+                (1117, 8, 3, b'foo\0foo\0README\0'), (1118, 8, 3, b'/usr/share/\0/usr/bin/\0/usr/share/foo/\0')])
+            files['bar-0.1-1.noarch.rpm'] = _rpmfile([
+                (1000, 6, 1, b'bar\0'), (1001, 6, 1, b'0.1\0'), (1002, 6, 1, b'1.el8\0'), (1022, 6, 1, b'noarch\0')])
+            for name, data in files.items():
+                open(os.path.join(repo.wwwdir, name), 'wb').write(data)
+            ### A damaged package is left out, including from the package counts
+            open(os.path.join(repo.wwwdir, 'damaged-1-1.noarch.rpm'), 'wb').write(b'\0' * 200)
+
+            repo.mrepomd()
+
+            repodata = os.path.join(repo.wwwdir, 'repodata')
+            repomd = xml.etree.ElementTree.parse(os.path.join(repodata, 'repomd.xml')).getroot()
+            md = {}
+            for data in repomd.findall('{http://linux.duke.edu/metadata/repo}data'):
+                location = data.find('{http://linux.duke.edu/metadata/repo}location').get('href')
+                raw = open(os.path.join(repo.wwwdir, location), 'rb').read()
+                self.assertEqual(data.findtext('{http://linux.duke.edu/metadata/repo}checksum'), hashlib.sha256(raw).hexdigest())
+                md[data.get('type')] = xml.etree.ElementTree.fromstring(gzip.decompress(raw))
+            self.assertEqual(sorted(md), ['filelists', 'other', 'primary'])
+            self.assertEqual([md[type].get('packages') for type in sorted(md)], ['2', '2', '2'])
+
+            common = '{http://linux.duke.edu/metadata/common}'
+            primary = dict([(pkg.findtext(common + 'name'), pkg) for pkg in md['primary'].findall(common + 'package')])
+            self.assertEqual(sorted(primary), ['bar', 'foo'])
+            foo = primary['foo']
+            self.assertEqual(foo.findtext(common + 'arch'), 'x86_64')
+            self.assertEqual(foo.find(common + 'version').attrib, {'epoch': '3', 'ver': '1.0', 'rel': '2'})
+            self.assertEqual(primary['bar'].find(common + 'version').attrib, {'epoch': '0', 'ver': '0.1', 'rel': '1.el8'})
+            checksum = hashlib.sha256(files['foo-1.0-2.x86_64.rpm']).hexdigest()
+            self.assertEqual(foo.findtext(common + 'checksum'), checksum)
+            self.assertEqual(foo.find(common + 'location').get('href'), 'foo-1.0-2.x86_64.rpm')
+            self.assertEqual(int(foo.find(common + 'size').get('package')), len(files['foo-1.0-2.x86_64.rpm']))
+            self.assertEqual(foo.findtext(common + 'summary'), 'The foo tool')
+            ### Only binaries and configuration go into primary
+            self.assertEqual([f.text for f in foo.iter(common + 'file')], ['/usr/bin/foo'])
+
+            filelists = '{http://linux.duke.edu/metadata/filelists}'
+            pkgs = dict([(pkg.get('name'), pkg) for pkg in md['filelists'].findall(filelists + 'package')])
+            self.assertEqual(pkgs['foo'].get('pkgid'), checksum)
+            self.assertEqual(pkgs['foo'].find(filelists + 'version').attrib, {'epoch': '3', 'ver': '1.0', 'rel': '2'})
+            self.assertEqual([(f.get('type'), f.text) for f in pkgs['foo'].findall(filelists + 'file')],
+                             [('dir', '/usr/share/foo'), (None, '/usr/bin/foo'), (None, '/usr/share/foo/README')])
+            self.assertEqual(pkgs['bar'].findall(filelists + 'file'), [])
+
+            other = '{http://linux.duke.edu/metadata/other}'
+            pkgs = dict([(pkg.get('name'), pkg) for pkg in md['other'].findall(other + 'package')])
+            self.assertEqual(pkgs['foo'].get('pkgid'), checksum)
+            self.assertEqual([(c.get('author'), c.get('date'), c.text) for c in pkgs['foo'].findall(other + 'changelog')],
+                             [('Jan <jan@example.com> - 3:1.0-2', '1577836800', '- Fix <bar> & baz')])
+            self.assertEqual(pkgs['bar'].findall(other + 'changelog'), [])
+        finally:
+            mrepo.cf = cf
+            shutil.rmtree(tmpdir)
+
+    def test_splitevr(self):
+        self.assertEqual(mrepo.splitevr('1:2.0-3.el5'), ('1', '2.0', '3.el5'))
+        self.assertEqual(mrepo.splitevr('2.0'), ('0', '2.0', None))
+        self.assertEqual(mrepo.splitevr(''), (None, None, None))
+
+class TestVercmp(unittest.TestCase):
+    def test_vercmp(self):
+        for a, b, result in (('1.0', '1.0', 0), ('1.0', '2.0', -1), ('2.0.1', '2.0', 1), ('1.10', '1.9', 1),
+                             ('1.010', '1.10', 0), ('1.0a', '1.0', 1), ('1.0', '1.a', 1), ('2.0', '2_0', 0),
+                             ('1.0~rc1', '1.0', -1), ('1.0~rc1', '1.0~rc2', -1), ('1.0^git1', '1.0', 1),
+                             ('1.0^git1', '1.0.1', -1), ('0.4.5', '0.4.6', -1), ('0.9', '0.10', -1)):
+            self.assertEqual(mrepo.vercmp(a, b), result, (a, b))
+            self.assertEqual(mrepo.vercmp(b, a), -result, (b, a))
+
+    def test_evrcmp(self):
+        self.assertEqual(mrepo.evrcmp(('1', '1.0', '1'), ('0', '2.0', '1')), 1)
+        self.assertEqual(mrepo.evrcmp(('0', '1.0', '2.el5'), ('', '1.0', '10.el5')), -1)
+        self.assertEqual(mrepo.evrcmp((None, '1.0', '1'), ('0', '1.0', '1')), 0)
+
+    def test_newest(self):
+        nevras = {'/a/foo-1.0-1.i386.rpm': ('foo', '0', '1.0', '1', 'i386'),
+                  '/a/foo-1.0-10.i386.rpm': ('foo', '0', '1.0', '10', 'i386'),
+                  '/a/foo-1.0-2.i386.rpm': ('foo', '0', '1.0', '2', 'i386'),
+                  '/a/foo-1.0-1.x86_64.rpm': ('foo', '0', '1.0', '1', 'x86_64'),
+                  '/a/bar-0.9-1.i386.rpm': ('bar', '1', '0.9', '1', 'i386'),
+                  '/a/bar-1.0-1.i386.rpm': ('bar', '0', '1.0', '1', 'i386')}
+        paths = sorted(nevras) + ['/a/unknown.rpm']
+        self.assertEqual(mrepo.newest(paths, nevras, 1),
+                         set(['/a/foo-1.0-10.i386.rpm', '/a/foo-1.0-1.x86_64.rpm', '/a/bar-0.9-1.i386.rpm', '/a/unknown.rpm']))
+        self.assertEqual(len(mrepo.newest(paths, nevras, 2)), 6)
+
+class TestPackageIndex(unittest.TestCase):
+    def setUp(self):
+        import tempfile
+        self.tmpdir = tempfile.mkdtemp()
+        self.srcdir = os.path.join(self.tmpdir, 'src')
+        os.makedirs(os.path.join(self.srcdir, 'sub'))
+        for f in ('a.rpm', 'sub/b.rpm', 'c.txt'):
+            open(os.path.join(self.srcdir, f), 'w').write('xx')
+        self.index = mrepo.PackageIndex(os.path.join(self.tmpdir, 'packages.db'))
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.tmpdir)
+
+    def test_scan(self):
+        srcdir = self.srcdir
+        target = [('a.rpm', srcdir, 2), ('b.rpm', os.path.join(srcdir, 'sub'), 2)]
+        self.assertEqual(list(self.index.scan(srcdir)), target)
+        self.assertEqual(list(self.index.list(srcdir)), target)
+        st = os.stat(os.path.join(srcdir, 'a.rpm'))
+        self.assertEqual(self.index.fileinfo(os.path.join(srcdir, 'a.rpm')), mrepo.statkey(st))
+
+    def test_rescan(self):
+        self.index.scan(self.srcdir)
+        os.unlink(os.path.join(self.srcdir, 'a.rpm'))
+        self.assertEqual(len(list(self.index.scan(self.srcdir))), 2)
+        self.assertEqual(len(list(self.index.scan(self.srcdir, rescan=True))), 1)
+        self.assertEqual(self.index.fileinfo(os.path.join(self.srcdir, 'a.rpm')), None)
+
+    def test_unchangeddir(self):
+        # rewriting a file in place does not move the directory mtime, but
+        # right after a scan the files themselves are compared
+        self.index.scan(self.srcdir)
+        open(os.path.join(self.srcdir, 'a.rpm'), 'w').write('xxxx')
+        self.assertEqual(list(self.index.scan(self.srcdir, rescan=True))[0], ('a.rpm', self.srcdir, 4))
+        self.assertEqual(mrepo.dirstate(os.path.join(self.srcdir, 'missing')), (0, 0))
+
+    def test_samemtime(self):
+        # a package added without moving the directory mtime is found right after a scan
+        st = os.stat(self.srcdir)
+        self.index.scan(self.srcdir)
+        open(os.path.join(self.srcdir, 'd.rpm'), 'w').write('xx')
+        os.utime(self.srcdir, ns=(st.st_atime_ns, st.st_mtime_ns))
+        self.assertEqual([name for name, dir, size in self.index.scan(self.srcdir, rescan=True)], ['a.rpm', 'b.rpm', 'd.rpm'])
+
+    def test_olddirs(self):
+        import sqlite3
+        # a dirs table from before the scanned column is started over
+        filename = os.path.join(self.tmpdir, 'old.db')
+        db = sqlite3.connect(filename)
+        db.execute('CREATE TABLE dirs (path TEXT PRIMARY KEY, parent TEXT, mtime INTEGER, nlink INTEGER)')
+        db.execute('INSERT INTO dirs VALUES (?, NULL, 1, 1)', (self.srcdir,))
+        db.commit()
+        db.close()
+        index = mrepo.PackageIndex(filename)
+        self.assertEqual(len(list(index.scan(self.srcdir))), 2)
+
+    def test_nevras(self):
+        self.index.scan(self.srcdir)
+        key = self.index.fileinfo(os.path.join(self.srcdir, 'a.rpm'))
+        hdr = {'name': 'a', 'epoch': 1, 'version': '1.0', 'release': '2', 'arch': 'noarch'}
+        self.index.addpackage(key, mrepo.Package(hdr, 'x', 2, 0, 96, 200))
+        self.assertEqual(self.index.nevras(self.srcdir), {os.path.join(self.srcdir, 'a.rpm'): ('a', '1', '1.0', '2', 'noarch')})
+
+    def test_commit(self):
+        import sqlite3
+        self.index.scan(self.srcdir)
+        key = self.index.fileinfo(os.path.join(self.srcdir, 'a.rpm'))
+        hdr = {'name': 'a', 'epoch': 0, 'version': '1.0', 'release': '1', 'arch': 'noarch'}
+        other = sqlite3.connect(self.index.filename, timeout=60)
+        ### Packages are committed in batches, not one by one
+        self.index.addpackage(key, mrepo.Package(hdr, 'x', 2, 0, 96, 200))
+        self.assertEqual(other.execute('SELECT COUNT(*) FROM packages').fetchone()[0], 0)
+        self.index.commit()
+        self.assertEqual(other.execute('SELECT COUNT(*) FROM packages').fetchone()[0], 1)
+        other.close()
+
+class TestMountTable(unittest.TestCase):
+    def setUp(self):
+        import tempfile
+        self.tmpdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmpdir, 'mountinfo')
+        open(self.filename, 'w').write(
+            '23 28 0:22 / /proc rw,relatime - proc proc rw\n'
+            '80 28 7:0 / /var/www/mrepo/fc6-i386/disc1 ro,relatime - iso9660 /var/mrepo/FC-6-i386\\040DVD.iso ro\n'
+            '81 28 0:50 / /var/www/mrepo/fc6-i386/os rw,nosuid shared:5 - fuse.unionfs fc6-i386-fuse rw\n')
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.tmpdir)
+
+    def test_index(self):
+        mounts = mrepo.MountTable(self.filename)
+        self.assertEqual(mounts.mountpoint('/var/mrepo/FC-6-i386 DVD.iso'), '/var/www/mrepo/fc6-i386/disc1')
+        self.assertEqual(mounts.mountpoint('fc6-i386-fuse'), '/var/www/mrepo/fc6-i386/os')
+        self.assertEqual(mounts.mountpoint('/var/mrepo/other.iso'), None)
+        self.assertTrue(mounts.ismount('/var/www/mrepo/fc6-i386/os/'))
+        self.assertFalse(mounts.ismount('/var/www/mrepo/fc6-i386/disc2'))
+        self.assertEqual(mounts.mount('/var/www/mrepo/fc6-i386/os'), ('fc6-i386-fuse', 'fuse.unionfs'))
+
+    def test_refresh(self):
+        mounts = mrepo.MountTable(self.filename)
+        self.assertTrue(mounts.ismount('/proc'))
+        open(self.filename, 'w').write('')
+        self.assertTrue(mounts.ismount('/proc'))
+        mounts.refresh()
+        self.assertFalse(mounts.ismount('/proc'))
+
+    def test_add(self):
+        mounts = mrepo.MountTable(self.filename)
+        self.assertTrue(mounts.ismount('/proc'))
+        open(self.filename, 'w').write('')
+        ### Mounts mrepo makes go into the index as they are, the table is not read again
+        mounts.add('/var/mrepo/FC-6-i386-disc2.iso', '/var/www/mrepo/fc6-i386/disc2', 'iso9660')
+        self.assertTrue(mounts.ismount('/proc'))
+        self.assertEqual(mounts.mountpoint('/var/mrepo/FC-6-i386-disc2.iso'), '/var/www/mrepo/fc6-i386/disc2')
+        mounts.remove('/var/www/mrepo/fc6-i386/disc1')
+        self.assertFalse(mounts.ismount('/var/www/mrepo/fc6-i386/disc1'))
+        self.assertEqual(mounts.mountpoint('/var/mrepo/FC-6-i386 DVD.iso'), None)
+        self.assertTrue(mounts.ismount('/var/www/mrepo/fc6-i386/disc2'))
+
+class TestIsoImage(unittest.TestCase):
+    tree = {'IMAGES': {'PXEBOOT': {'VMLINUZ.;1': b'kernel' * 1000}}, 'README.TXT;1': b'read me'}
+    names = {'README.TXT;1': b'ReadMe.txt'}
+
+    def setUp(self):
+        import tempfile
+        self.tmpdir = tempfile.mkdtemp()
+        self.iso = os.path.join(self.tmpdir, 'disc1.iso')
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.tmpdir)
+
+    def contents(self, image, path):
+        file = os.path.join(self.tmpdir, 'extracted')
+        image.extract(path, file)
+        return open(file, 'rb').read()
+
+    def record(self, name, extent, size, isdir, su=b''):
+        import struct
+        pad = len(name) % 2 == 0 and b'\0' or b''
+        body = (struct.pack('<II', extent, 0) + struct.pack('<II', size, 0) +
+                bytes([120, 1, 2, 3, 4, 5, 0, isdir and 2 or 0, 0, 0]) + struct.pack('<HH', 1, 1) +
+                bytes([len(name)]) + name + pad + su)
+        return bytes([len(body) + 2, 0]) + body
+
+    def build(self, rockridge=False):
+        ### Sector 16 holds the primary volume descriptor, 17 the terminator, the tree starts at 18
+        sectors = {}
+        def layout(tree, block):
+            sectors[block] = None
+            next = block + 1
+            children = []
+            for name, value in sorted(tree.items()):
+                if isinstance(value, dict):
+                    children.append((name, next, 2048, True))
+                    next = layout(value, next)
+                else:
+                    children.append((name, next, len(value), False))
+                    sectors[next] = value
+                    next = next + (len(value) + 2047) // 2048
+            data = self.record(b'\0', block, 2048, True, rockridge and b'SP\x07\x01\xbe\xef\0' or b'')
+            data = data + self.record(b'\1', block, 2048, True)
+            for name, extent, size, isdir in children:
+                su = b''
+                if rockridge and name in self.names:
+                    su = b'NM' + bytes([5 + len(self.names[name]), 1, 0]) + self.names[name]
+                data = data + self.record(name.encode(), extent, size, isdir, su)
+            sectors[block] = data
+            return next
+        end = layout(self.tree, 18)
+        image = bytearray(end * 2048)
+        image[16*2048:16*2048+7] = b'\1CD001\1'
+        image[16*2048+156:16*2048+190] = self.record(b'\0', 18, 2048, True)
+        image[17*2048:17*2048+7] = b'\xffCD001\1'
+        for block, data in sectors.items():
+            image[block*2048:block*2048+len(data)] = data
+        open(self.iso, 'wb').write(image)
+
+    def test_parse(self):
+        self.build()
+        image = mrepo.IsoImage(self.iso)
+        self.assertEqual(sorted(image.entries), ['images', 'images/pxeboot', 'images/pxeboot/vmlinuz', 'readme.txt'])
+        self.assertEqual(self.contents(image, 'images/pxeboot/vmlinuz'), b'kernel' * 1000)
+        self.assertEqual(image.entries['readme.txt'][2], 1577934245)
+        image.close()
+
+    def test_rockridge(self):
+        self.build(rockridge=True)
+        image = mrepo.IsoImage(self.iso)
+        self.assertTrue('ReadMe.txt' in image.entries)
+        self.assertEqual(self.contents(image, 'ReadMe.txt'), b'read me')
+        image.close()
+
+    def test_unsafenames(self):
+        self.tree = {'A.;1': b'a', 'B.;1': b'b', 'C.;1': b'c', 'IMAGES': {'D.;1': b'd'}}
+        self.names = {'A.;1': b'..', 'B.;1': b'../../b', 'C.;1': b'c', 'IMAGES': b'images'}
+        self.build(rockridge=True)
+        image = mrepo.IsoImage(self.iso)
+        self.assertEqual(sorted(image.entries), ['c', 'images', 'images/d'])
+        ### An index from elsewhere, or a symlink in the tree, cannot escape dst either
+        dst = os.path.join(self.tmpdir, 'disc1')
+        os.makedirs(dst)
+        os.symlink(self.tmpdir, os.path.join(dst, 'images'))
+        image.entries['../escape'] = image.entries['c']
+        self.assertEqual(image.extracttree(dst), 1)
+        self.assertEqual(sorted(os.listdir(self.tmpdir)), ['disc1', 'disc1.iso'])
+        image.close()
+
+    def test_extracttree(self):
+        self.build()
+        cache = os.path.join(self.tmpdir, 'isoindex', 'disc1.json')
+        dst = os.path.join(self.tmpdir, 'disc1')
+        image = mrepo.IsoImage(self.iso, cache)
+        self.assertEqual(image.extracttree(dst), 2)
+        self.assertEqual(image.extracttree(dst), 0)
+        self.assertEqual(open(os.path.join(dst, 'images/pxeboot/vmlinuz'), 'rb').read(), b'kernel' * 1000)
+        self.assertEqual(os.stat(os.path.join(dst, 'readme.txt')).st_mtime, 1577934245)
+        image.close()
+        self.assertTrue(os.path.exists(cache))
+        image = mrepo.IsoImage(self.iso, cache)
+        self.assertEqual(image.extracttree(dst), 0)
+        image.close()
+
+    def test_payload(self):
+        self.tree = {'PACKAGES': {'A.RPM;1': b'a'}, 'REPODATA': {'COMPS.XML;1': b'c', 'PRIMARY.XML;1': b'p'},
+                     'LIVEOS': {'SQUASHFS.IMG;1': b's'}}
+        self.build()
+        dst = os.path.join(self.tmpdir, 'disc1')
+        image = mrepo.IsoImage(self.iso)
+        ### Only what mrepo uses from a disc is extracted
+        self.assertEqual(image.extracttree(dst, mrepo.isopayload), 2)
+        self.assertEqual(sorted(os.listdir(dst)), ['packages', 'repodata'])
+        self.assertEqual(os.listdir(os.path.join(dst, 'repodata')), ['comps.xml'])
+        image.close()
+
+    def test_celoop(self):
+        import struct
+        self.build()
+        ### A continuation area that points back at itself is read once
+        block = os.path.getsize(self.iso) // 2048
+        ce = b'CE' + bytes([28, 1]) + struct.pack('<I4xI4xI4x', block, 0, 34)
+        area = b'NM' + bytes([6, 1, 0]) + b'x' + ce
+        open(self.iso, 'ab').write(area + b'\0' * (2048 - len(area)))
+        image = mrepo.IsoImage(self.iso)
+        self.assertEqual(image.susp(ce), {b'NM': b'x'})
+        image.close()
+
+class TestMergeTrees(unittest.TestCase):
+    def setUp(self):
+        import tempfile
+        self.tmpdir = tempfile.mkdtemp()
+        for f, data in (('disc1/Packages/a.rpm', '1'), ('disc1/.discinfo', '1'), ('disc1/images/boot.iso', '1'),
+                        ('disc2/Packages/b.rpm', '2'), ('disc2/.discinfo', '2'), ('disc2/images', '2')):
+            if not os.path.isdir(os.path.dirname(os.path.join(self.tmpdir, f))):
+                os.makedirs(os.path.dirname(os.path.join(self.tmpdir, f)))
+            open(os.path.join(self.tmpdir, f), 'w').write(data)
+        self.discs = [os.path.join(self.tmpdir, 'disc1'), os.path.join(self.tmpdir, 'disc2')]
+        self.osdir = os.path.join(self.tmpdir, 'os')
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.tmpdir)
+
+    def test_mergetrees(self):
+        merged = mrepo.mergetrees(self.discs)
+        self.assertEqual(merged['Packages'], None)
+        self.assertEqual(merged['Packages/b.rpm'], os.path.join(self.discs[1], 'Packages/b.rpm'))
+        self.assertEqual(merged['.discinfo'], os.path.join(self.discs[0], '.discinfo'))
+        self.assertEqual(merged['images'], None)
+
+    def test_symlinkfarm(self):
+        self.assertEqual(mrepo.symlinkfarm(mrepo.mergetrees(self.discs), self.osdir), 6)
+        self.assertEqual(open(os.path.join(self.osdir, '.discinfo')).read(), '1')
+        self.assertEqual(os.readlink(os.path.join(self.osdir, 'Packages/b.rpm')), '../../disc2/Packages/b.rpm')
+        self.assertEqual(mrepo.symlinkfarm(mrepo.mergetrees(self.discs), self.osdir), 0)
+        os.unlink(os.path.join(self.discs[0], '.discinfo'))
+        os.unlink(os.path.join(self.discs[1], 'Packages/b.rpm'))
+        self.assertEqual(mrepo.symlinkfarm(mrepo.mergetrees(self.discs), self.osdir), 3)
+        self.assertEqual(open(os.path.join(self.osdir, '.discinfo')).read(), '2')
+        self.assertFalse(os.path.lexists(os.path.join(self.osdir, 'Packages/b.rpm')))
+
+    def test_umount(self):
+        class TestConfig:
+            wwwdir = self.tmpdir
+            srcdir = self.tmpdir
+            unionfs = True
+            unionfsmethod = 'native'
+            isoreader = 'mount'
+            cmd = {'umount': '/bin/true'}
+        cf = mrepo.cf if hasattr(mrepo, 'cf') else None
+        mrepo.cf = TestConfig()
+        try:
+            dist = mrepo.Dist('test', 'i386', mrepo.cf)
+            dist.dir = self.tmpdir
+            dist.unionfs = True
+            ### Only an os/ tree made by symlinkfarm() is removed
+            os.mkdir(self.osdir)
+            open(os.path.join(self.osdir, 'a.rpm'), 'w').write('real')
+            dist.umount()
+            self.assertTrue(os.path.isfile(os.path.join(self.osdir, 'a.rpm')))
+            os.unlink(os.path.join(self.osdir, 'a.rpm'))
+            mrepo.symlinkfarm(mrepo.mergetrees(self.discs), self.osdir)
+            dist.unionfs = False
+            dist.umount()
+            self.assertTrue(os.path.isdir(self.osdir))
+            dist.unionfs = True
+            dist.umount()
+            self.assertFalse(os.path.exists(self.osdir))
+        finally:
+            mrepo.cf = cf
+
+class TestListings(unittest.TestCase):
+    def setUp(self):
+        import tempfile
+        self.tmpdir = tempfile.mkdtemp()
+        self.srcdir = os.path.join(self.tmpdir, 'src')
+        os.makedirs(os.path.join(self.srcdir, 'sub'))
+        for f in ('a.rpm', 'sub/b.rpm'):
+            open(os.path.join(self.srcdir, f), 'w').write('rpm')
+        self.listings = mrepo.Listings()
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.tmpdir)
+
+    def test_rpms(self):
+        rpms = [('a.rpm', self.srcdir, 3), ('b.rpm', os.path.join(self.srcdir, 'sub'), 3)]
+        self.assertEqual(list(self.listings.rpms(self.srcdir)), rpms)
+        self.assertEqual(self.listings.size(os.path.join(self.srcdir, 'sub', 'b.rpm')), 3)
+        open(os.path.join(self.srcdir, 'c.rpm'), 'w').write('rpm')
+        open(os.path.join(self.srcdir, 'sub', 'b.rpm'), 'w').write('rpmrpm')
+        self.assertEqual(list(self.listings.rpms(self.srcdir + '/')), rpms)
+        self.listings.invalidate(os.path.join(self.srcdir, 'sub'))
+        self.assertEqual(self.listings.size(os.path.join(self.srcdir, 'sub', 'b.rpm')), None)
+        self.assertEqual(len(list(self.listings.rpms(self.srcdir))), 3)
+        self.assertEqual(self.listings.size(os.path.join(self.srcdir, 'sub', 'b.rpm')), 6)
+
+    def test_sha1(self):
+        class TestConfig:
+            srcdir = self.srcdir
+            wwwdir = os.path.join(self.tmpdir, 'www')
+        repo = mrepo.Repo('test', '', mrepo.Dist('test', 'i386', TestConfig()), TestConfig())
+        repo.linked = [('a.rpm', os.path.join(self.srcdir, 'a.rpm'))]
+        listings = mrepo.listings
+        mrepo.listings = self.listings
+        try:
+            list(self.listings.rpms(self.srcdir))
+            cursha1 = repo.sha1()
+            self.assertEqual(repo.sha1(cached=False), cursha1)
+            ### A file that changed after listing is only noticed by looking at it
+            open(os.path.join(self.srcdir, 'a.rpm'), 'w').write('changed')
+            self.assertEqual(repo.sha1(), cursha1)
+            self.assertNotEqual(repo.sha1(cached=False), cursha1)
+        finally:
+            mrepo.listings = listings
+
+    def test_links(self):
+        wwwdir = os.path.join(self.tmpdir, 'www')
+        os.mkdir(wwwdir)
+        os.symlink('../src/a.rpm', os.path.join(wwwdir, 'a.rpm'))
+        self.assertEqual(self.listings.links(wwwdir), [('a.rpm', '../src/a.rpm')])
+        self.listings.setlinks(wwwdir, [])
+        self.assertEqual(self.listings.links(wwwdir), [])
+
+class TestConfigCache(unittest.TestCase):
+    def setUp(self):
+        import tempfile
+        self.tmpdir = tempfile.mkdtemp()
+        self.confdir = os.path.join(self.tmpdir, 'conf.d')
+        os.mkdir(self.confdir)
+        self.configfile = os.path.join(self.tmpdir, 'mrepo.conf')
+        open(self.configfile, 'w').write('[main]\nsrcdir = %s/src\nwwwdir = %s/www\ncachedir = %s/cache\nconfdir = %s\n'
+                                         % (self.tmpdir, self.tmpdir, self.tmpdir, self.confdir))
+        open(os.path.join(self.confdir, 'centos.conf'), 'w').write(
+            '[variables]\nmirror = http://mirror\n\n[centos5]\nrelease = 5\narch = i386 x86_64\nos = $mirror/$release/$arch/$repo\n')
+        self.op = mrepo.op
+        mrepo.op = mrepo.Options(['-c', self.configfile])
+
+    def tearDown(self):
+        import shutil
+        mrepo.op = self.op
+        shutil.rmtree(self.tmpdir)
+
+    def dists(self, cf):
+        return [(dist.nick, dist.release, dist.enabled, [(repo.name, repo.url) for repo in dist.repos]) for dist in cf.alldists]
+
+    def test_cache(self):
+        compiled = self.dists(mrepo.readconfig())
+        self.assertEqual(compiled[0], ('centos5-i386', '5', True, [('os', 'http://mirror/5/i386/os')]))
+        self.assertTrue(os.path.exists(os.path.join(self.tmpdir, 'cache', 'config.json')))
+        ### Reading again must not parse the dist files while their size and mtime stay the same
+        file = os.path.join(self.confdir, 'centos.conf')
+        st = os.stat(file)
+        data = open(file).read()
+        open(file, 'w').write(data.replace('release = 5', 'release = 7'))
+        os.utime(file, ns=(st.st_atime_ns, st.st_mtime_ns))
+        self.assertEqual(self.dists(mrepo.readconfig()), compiled)
+
+    def test_changed(self):
+        mrepo.readconfig()
+        open(os.path.join(self.confdir, 'fedora.conf'), 'w').write('[fc6]\nrelease = 6\n')
+        self.assertEqual(len(mrepo.readconfig().alldists), 3)
+
+    def test_named(self):
+        ### Only the named dists are created, whether the compiled configuration is cached or not
+        mrepo.op = mrepo.Options(['-c', self.configfile, 'centos5-x86_64'])
+        self.assertEqual([dist.nick for dist in mrepo.readconfig().alldists], ['centos5-x86_64'])
+        self.assertEqual([dist.nick for dist in mrepo.readconfig().alldists], ['centos5-x86_64'])
+        mrepo.op = mrepo.Options(['-c', self.configfile, 'centos5'])
+        self.assertEqual(len(mrepo.readconfig().alldists), 2)
+
+    def test_url(self):
+        import http.server, threading
+        config = open(self.configfile, 'rb').read()
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.headers.get('If-None-Match') == '"1"':
+                    self.send_response(304)
+                    self.end_headers()
+                    return
+                self.send_response(200)
+                self.send_header('ETag', '"1"')
+                self.send_header('Content-Length', str(len(config)))
+                self.end_headers()
+                self.wfile.write(config)
+            def log_message(self, *args):
+                pass
+        server = http.server.HTTPServer(('127.0.0.1', 0), Handler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        try:
+            mrepo.op = mrepo.Options(['-c', 'http://127.0.0.1:%d/mrepo.conf' % server.server_port])
+            cf = mrepo.readconfig()
+            ### The copy of a downloaded config file is kept in its cachedir
+            self.assertEqual(cf.urlcachedir, os.path.join(self.tmpdir, 'cache', 'config'))
+            self.assertEqual(len(os.listdir(cf.urlcachedir)), 1)
+            self.assertEqual(len(cf.alldists), 2)
+        finally:
+            server.shutdown()
+            server.server_close()
+            thread.join()
+
+class TestMirrorSessions(unittest.TestCase):
+    def setUp(self):
+        import tempfile
+        self.tmpdir = tempfile.mkdtemp()
+        self.log = os.path.join(self.tmpdir, 'rsync.log')
+        rsync = os.path.join(self.tmpdir, 'rsync')
+        open(rsync, 'w').write('#!/bin/sh\necho "$@" >> %s\n' % self.log)
+        os.chmod(rsync, 0o755)
+
+        class TestConfig:
+            cmd = {'rsync': rsync, 'lftp': '', 'mirrordir': ''}
+            mirrorselection = False
+            httpmirror = 'native'
+            upstreamprobe = False
+            rsyncoptions = '-rtHL'
+            rsynctimeout = None
+            rsynccleanup = True
+            rsyncbwlimit = None
+            rsyncexclheaders = True
+            rsyncexclrepodata = True
+            rsyncexclsrpm = True
+            rsyncexcldebug = True
+            srcdir = os.path.join(self.tmpdir, 'src')
+            wwwdir = os.path.join(self.tmpdir, 'www')
+            cachedir = os.path.join(self.tmpdir, 'cache')
+            lockdir = os.path.join(self.tmpdir, 'cache')
+        self.cf = mrepo.cf if hasattr(mrepo, 'cf') else None
+        mrepo.cf = TestConfig()
+        self.dist = mrepo.Dist('test', 'i386', mrepo.cf)
+
+    def tearDown(self):
+        import shutil
+        mrepo.cf = self.cf
+        shutil.rmtree(self.tmpdir)
+
+    def test_sessions(self):
+        repos = [mrepo.Repo('os', 'rsync://mirror/centos/5/os/i386/', self.dist, mrepo.cf),
+                 mrepo.Repo('updates', 'rsync://mirror/centos/5/updates/i386/', self.dist, mrepo.cf),
+                 mrepo.Repo('extras', 'rsync://mirror/centos/5/updates/i386/extras/', self.dist, mrepo.cf),
+                 mrepo.Repo('addons', 'rsync://mirror/centos/5/addons/i386', self.dist, mrepo.cf),
+                 mrepo.Repo('epel', 'rsync://mirror/epel/5/i386/', self.dist, mrepo.cf)]
+        mrepo.mirrorsessions(repos, 3)
+        self.assertEqual(repos[0].batched, {'rsync://mirror/centos/5/os/i386/': None})
+        self.assertEqual(repos[3].batched, {'rsync://mirror/centos/5/addons/i386': None})
+        ### Nested paths and lone URLs are left to their repositories
+        self.assertEqual(repos[1].batched, {})
+        self.assertEqual(repos[2].batched, {})
+        self.assertEqual(repos[4].batched, {})
+        calls = open(self.log).read().splitlines()
+        self.assertEqual(len(calls), 1)
+        self.assertTrue(' -R ' in calls[0])
+        self.assertTrue('rsync://mirror/centos/./5/os/i386/ rsync://mirror/centos/./5/addons/i386/ ' in calls[0])
+        self.assertTrue('--exclude=/5/os/i386/repodata/' in calls[0])
+        self.assertEqual(os.listdir(os.path.join(self.tmpdir, 'cache')), ['test-i386'])
+        ### The update locks stay with the repositories until mirrorrepo is done with them
+        lockdir = os.path.join(self.tmpdir, 'cache', 'test-i386')
+        self.assertEqual(len([name for name in os.listdir(lockdir) if name.startswith('update-')]), 5)
+        for repo in repos:
+            self.assertTrue(mrepo.mirrorrepo(repo))
+        self.assertEqual([name for name in os.listdir(lockdir) if name.startswith('update-')], [])
+        self.assertEqual(len(open(self.log).read().splitlines()), 4)
+
+    def test_reposync(self):
+        reposync = os.path.join(self.tmpdir, 'reposync')
+        open(reposync, 'w').write('#!/bin/sh\necho "$@" >> %s\n'
+                                  'while [ "$1" ]; do case "$1" in -c) cat "$2" >> %s;; -r) repos="$repos $2";; -p) dst="$2";; esac; shift; done\n'
+                                  'for repo in $repos; do touch "$dst/$repo/$repo.rpm"; done\n' % (self.log, self.log))
+        os.chmod(reposync, 0o755)
+        mrepo.cf.cmd['reposync'] = reposync
+        mrepo.cf.reposyncoptions = ''
+        mrepo.cf.reposyncnorepopath = True
+        mrepo.cf.reposynccleanup = False
+        mrepo.cf.reposyncnewestonly = False
+        mrepo.cf.reposynctimeout = None
+        mrepo.cf.reposyncminrate = None
+        repos = [mrepo.Repo('os', 'reposync://mirror/centos/5/os/i386/', self.dist, mrepo.cf),
+                 mrepo.Repo('updates', 'reposyncs://mirror/centos/5/updates/i386/', self.dist, mrepo.cf),
+                 mrepo.Repo('epel', 'reposync://mirror/epel/5/i386/ reposync://other/epel/5/i386/', self.dist, mrepo.cf)]
+        mrepo.mirrorsessions(repos)
+        self.assertEqual(repos[0].batched, {'reposync://mirror/centos/5/os/i386/': None})
+        self.assertEqual(repos[1].batched, {'reposyncs://mirror/centos/5/updates/i386/': None})
+        ### A repository with several URLs is left to itself
+        self.assertEqual(repos[2].batched, {})
+        calls = open(self.log).read()
+        self.assertEqual(calls.splitlines()[0].count('-r '), 2)
+        self.assertTrue('-r test-i386-os -r test-i386-updates -p ' in calls)
+        self.assertFalse('--norepopath' in calls)
+        self.assertTrue('[test-i386-updates]\nname=test-i386-updates\nbaseurl=https://mirror/centos/5/updates/i386/\n' in calls)
+        self.assertEqual(os.listdir(os.path.join(self.tmpdir, 'cache')), ['test-i386'])
+        self.assertEqual(os.listdir(repos[0].srcdir), ['test-i386-os.rpm'])
+
+        ### Without --norepopath packages go below a directory named after the repository, as with a single run
+        mrepo.cf.reposyncnorepopath = False
+        for repo in repos:
+            repo.batched = {}
+        mrepo.mirrorsessions(repos[:2])
+        self.assertEqual(os.listdir(os.path.join(repos[0].srcdir, 'test-i386-os')), ['test-i386-os.rpm'])
+
+class TestDedup(unittest.TestCase):
+    def setUp(self):
+        import tempfile
+        self.tmpdir = tempfile.mkdtemp()
+        self.srcdir = os.path.join(self.tmpdir, 'src')
+        os.makedirs(os.path.join(self.srcdir, 'sub'))
+        for f, data in (('a.rpm', 'same'), ('sub/a.rpm', 'same'), ('b.rpm', 'diff'), ('c.rpm', 'same')):
+            open(os.path.join(self.srcdir, f), 'w').write(data)
+        os.symlink(os.path.join(self.srcdir, 'a.rpm'), os.path.join(self.srcdir, 'link.rpm'))
+        self.pkgindex = mrepo.pkgindex
+        mrepo.pkgindex = mrepo.PackageIndex(os.path.join(self.tmpdir, 'packages.db'))
+
+    def tearDown(self):
+        import shutil
+        mrepo.pkgindex = self.pkgindex
+        shutil.rmtree(self.tmpdir)
+
+    def test_dedup(self):
+        srcdir = self.srcdir
+        self.assertEqual(mrepo.dedup(srcdir), (2, 8))
+        inodes = [os.stat(os.path.join(srcdir, f)).st_ino for f in ('a.rpm', 'sub/a.rpm', 'c.rpm')]
+        self.assertEqual(len(set(inodes)), 1)
+        self.assertNotEqual(os.stat(os.path.join(srcdir, 'b.rpm')).st_ino, inodes[0])
+        self.assertTrue(os.path.islink(os.path.join(srcdir, 'link.rpm')))
+        self.assertEqual(mrepo.dedup(srcdir), (0, 0))
+
+    def test_dedupindex(self):
+        # hashes are kept in the index, so known files are not read again
+        mrepo.dedup(self.srcdir)
+        st = os.stat(os.path.join(self.srcdir, 'a.rpm'))
+        fasthash, checksum = mrepo.pkgindex.gethash(mrepo.statkey(st))
+        self.assertEqual(checksum, mrepo.filehash(os.path.join(self.srcdir, 'a.rpm')))
+        self.assertEqual(fasthash, mrepo.fasthash(os.path.join(self.srcdir, 'a.rpm'), 4))
+
+class TestBandwidth(unittest.TestCase):
+    def test_parsesize(self):
+        self.assertEqual(mrepo.parsesize(''), 0)
+        self.assertEqual(mrepo.parsesize('512'), 512)
+        self.assertEqual(mrepo.parsesize('2k'), 2048)
+        self.assertEqual(mrepo.parsesize('1.5M'), 1572864)
+
+    def test_rate(self):
+        import time
+        bw = mrepo.Bandwidth('10M', 'mirror.example.com=1M', '08:00-18:00=2M 22:00-06:00=0')
+        day = time.mktime((2020, 1, 1, 12, 0, 0, 0, 0, -1))
+        night = time.mktime((2020, 1, 1, 23, 0, 0, 0, 0, -1))
+        evening = time.mktime((2020, 1, 1, 20, 0, 0, 0, 0, -1))
+        self.assertEqual(bw.rate(now=day), 2097152)
+        self.assertEqual(bw.rate(now=night), 0)
+        self.assertEqual(bw.rate(now=evening), 10485760)
+        self.assertEqual(bw.rate('mirror.example.com'), 1048576)
+        self.assertEqual(bw.rate('other.example.com'), 0)
+
+    def test_take(self):
+        bw = mrepo.Bandwidth('', 'mirror.example.com=1000')
+        self.assertEqual(bw.take(5000, 'other.example.com'), 0)
+        self.assertEqual(bw.take(1500, 'mirror.example.com'), 0)
+        self.assertTrue(0 < bw.take(1, 'mirror.example.com') <= 0.5)
+
+    def test_takeonce(self):
+        ### Without a host the global bucket is only charged once
+        bw = mrepo.Bandwidth('1000')
+        self.assertEqual(bw.take(600), 0)
+        self.assertEqual(bw.take(1), 0)
+
+    def test_consume(self):
+        import threading, time
+        bw = mrepo.Bandwidth('', 'a.example.com=1000 b.example.com=1000')
+        bw.take(2000, 'a.example.com')
+        ### A higher priority waiting for another host does not hold up this one
+        waiter = threading.Thread(target=bw.consume, args=(1, 'a.example.com', 5))
+        waiter.start()
+        time.sleep(0.1)
+        start = time.time()
+        bw.consume(1, 'b.example.com', 0)
+        self.assertTrue(time.time() - start < 0.5)
+        waiter.join()
+
+    def test_share(self):
+        bw = mrepo.Bandwidth('4M', 'mirror.example.com=1M')
+        bw.enter()
+        bw.enter()
+        self.assertEqual(bw.share('rsync://mirror.example.com/centos/'), 524288)
+        self.assertEqual(bw.share('http://other.example.com/centos/'), 2097152)
+        bw.leave()
+        self.assertEqual(bw.share('http://other.example.com/centos/'), 4194304)
+
+class TestMirrorHTTP(unittest.TestCase):
+    def setUp(self):
+        import gzip, hashlib, io, tempfile, threading, http.server, functools
+        self.tmpdir = tempfile.mkdtemp()
+        self.updir = os.path.join(self.tmpdir, 'up')
+        self.srcdir = os.path.join(self.tmpdir, 'src')
+        os.makedirs(os.path.join(self.updir, 'repodata'))
+        os.makedirs(os.path.join(self.updir, 'Packages'))
+        primary = '<metadata xmlns="http://linux.duke.edu/metadata/common" packages="3">\n'
+        for name, arch in (('foo', 'x86_64'), ('foo-debuginfo', 'x86_64'), ('foo', 'src')):
+            href = 'Packages/%s-1.0-1.%s.rpm' % (name, arch)
+            data = ('%s-%s' % (name, arch)).encode()
+            open(os.path.join(self.updir, href), 'wb').write(data)
+            primary += '<package type="rpm"><name>%s</name><arch>%s</arch>' % (name, arch)
+            primary += '<checksum type="sha256" pkgid="YES">%s</checksum>' % hashlib.sha256(data).hexdigest()
+            primary += '<size package="%d"/><location href="%s"/></package>\n' % (len(data), href)
+        primary = gzip.compress((primary + '</metadata>\n').encode())
+        open(os.path.join(self.updir, 'repodata', 'primary.xml.gz'), 'wb').write(primary)
+        open(os.path.join(self.updir, 'repodata', 'repomd.xml'), 'w').write(
+            '<repomd xmlns="http://linux.duke.edu/metadata/repo"><data type="primary">'
+            '<checksum type="sha256">%s</checksum><location href="repodata/primary.xml.gz"/></data></repomd>\n'
+            % hashlib.sha256(primary).hexdigest())
+
+        class RangeHandler(http.server.SimpleHTTPRequestHandler):
+            ### Answer ranges from the start of the file, like a broken cache
+            badrange = False
+
+            def log_message(self, *args):
+                pass
+
+            def send_head(self):
+                path = self.translate_path(self.path)
+                if not self.headers.get('Range') or not os.path.isfile(path):
+                    return http.server.SimpleHTTPRequestHandler.send_head(self)
+                start, end = self.headers['Range'][6:].split('-')
+                data = open(path, 'rb').read()
+                start, end = not self.badrange and int(start) or 0, end and int(end) or len(data) - 1
+                self.send_response(206)
+                self.send_header('Content-Range', 'bytes %d-%d/%d' % (start, end, len(data)))
+                data = data[start:end + 1]
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                return io.BytesIO(data)
+
+        self.handler = RangeHandler
+        handler = functools.partial(RangeHandler, directory=self.updir)
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = 'http://127.0.0.1:%d/' % self.server.server_address[1]
+
+        class TestConfig:
+            httptimeout = 10
+            quarantinedir = os.path.join(self.tmpdir, 'quarantine')
+            httpsegmentsize = 0
+            srcdir = self.srcdir
+            wwwdir = os.path.join(self.tmpdir, 'www')
+            cachedir = os.path.join(self.tmpdir, 'cache')
+            httpconnections = 2
+            httpcleanup = True
+            httpexcldebug = True
+            httpexclsrpm = True
+            packagestore = False
+            storedir = os.path.join(self.tmpdir, 'store')
+        self.cf = mrepo.cf if hasattr(mrepo, 'cf') else None
+        mrepo.cf = TestConfig()
+
+    def tearDown(self):
+        import shutil
+        self.server.shutdown()
+        self.server.server_close()
+        mrepo.cf = self.cf
+        shutil.rmtree(self.tmpdir)
+
+    def test_mirrorhttp(self):
+        os.makedirs(os.path.join(self.srcdir, 'Packages'))
+        open(os.path.join(self.srcdir, 'Packages', 'old-1.0-1.x86_64.rpm'), 'w').write('old')
+        mrepo.mirrorhttp(self.url, self.srcdir, None)
+        self.assertEqual(sorted(os.listdir(os.path.join(self.srcdir, 'Packages'))), ['foo-1.0-1.x86_64.rpm'])
+        self.assertEqual(open(os.path.join(self.srcdir, 'Packages', 'foo-1.0-1.x86_64.rpm')).read(), 'foo-x86_64')
+
+    def test_packagestore(self):
+        import shutil
+        mrepo.cf.packagestore = True
+        other = os.path.join(self.tmpdir, 'other')
+        mrepo.mirrorhttp(self.url, self.srcdir, None)
+        ### The second repository finds the package in the store, it is gone upstream
+        os.unlink(os.path.join(self.updir, 'Packages', 'foo-1.0-1.x86_64.rpm'))
+        mrepo.mirrorhttp(self.url, other, None)
+        file = os.path.join(other, 'Packages', 'foo-1.0-1.x86_64.rpm')
+        self.assertEqual(open(file).read(), 'foo-x86_64')
+        self.assertEqual(os.stat(file).st_nlink, 3)
+        self.assertTrue(os.path.samefile(file, os.path.join(self.srcdir, 'Packages', 'foo-1.0-1.x86_64.rpm')))
+        self.assertEqual(mrepo.prunestore(mrepo.cf.storedir), (0, 0))
+        shutil.rmtree(self.srcdir)
+        shutil.rmtree(other)
+        ### Files the store did not put there are left alone, as is a store overlapping a repository
+        open(os.path.join(mrepo.cf.storedir, 'README'), 'w').write('keep')
+        self.assertEqual(mrepo.prunestore(mrepo.cf.storedir, [self.tmpdir]), (0, 0))
+        self.assertEqual(mrepo.prunestore(mrepo.cf.storedir, [os.path.join(mrepo.cf.storedir, 'sha256')]), (0, 0))
+        self.assertEqual(mrepo.prunestore(mrepo.cf.storedir, [self.srcdir, other]), (1, 10))
+        self.assertEqual(sorted(os.listdir(mrepo.cf.storedir)), ['README', 'sha256'])
+
+    def test_fetchresume(self):
+        import hashlib
+        dst = os.path.join(self.tmpdir, 'foo.rpm')
+        open(dst + '.part', 'w').write('foo-')
+        checksum = hashlib.sha256(b'foo-x86_64').hexdigest()
+        pool = mrepo.HTTPPool(timeout=10)
+        self.assertEqual(mrepo.fetchpackage(pool, self.url + 'Packages/foo-1.0-1.x86_64.rpm', dst, 10, 'sha256', checksum), None)
+        pool.close()
+        self.assertEqual(open(dst).read(), 'foo-x86_64')
+        self.assertFalse(os.path.exists(dst + '.part'))
+
+    def test_fetchbadrange(self):
+        dst = os.path.join(self.tmpdir, 'foo.rpm')
+        open(dst + '.part', 'w').write('foo-')
+        self.handler.badrange = True
+        pool = mrepo.HTTPPool(timeout=10)
+        self.assertTrue(mrepo.fetchpackage(pool, self.url + 'Packages/foo-1.0-1.x86_64.rpm', dst, 10))
+        pool.close()
+        self.assertFalse(os.path.exists(dst))
+        self.assertEqual(os.path.getsize(dst + '.part'), 0)
+
+    def test_fetchcomplete(self):
+        import hashlib
+        dst = os.path.join(self.tmpdir, 'foo.rpm')
+        open(dst + '.part', 'w').write('foo-x86_64')
+        checksum = hashlib.sha256(b'foo-x86_64').hexdigest()
+        pool = mrepo.HTTPPool(timeout=10)
+        ### A complete partial download is verified without asking the server, which does not have it
+        self.assertEqual(mrepo.fetchpackage(pool, self.url + 'missing.rpm', dst, 10, 'sha256', checksum), None)
+        pool.close()
+        self.assertEqual(open(dst).read(), 'foo-x86_64')
+
+    def test_fetchquarantine(self):
+        import hashlib
+        dst = os.path.join(self.tmpdir, 'foo.rpm')
+        pool = mrepo.HTTPPool(timeout=10)
+        ### Old yum metadata names sha1 'sha'
+        self.assertTrue(mrepo.fetchpackage(pool, self.url + 'Packages/foo-1.0-1.x86_64.rpm', dst, 10, 'sha', 'bad'))
+        self.assertTrue(mrepo.fetchpackage(pool, self.url + 'Packages/foo-1.0-1.x86_64.rpm', dst, 10, 'sha', 'bad'))
+        pool.close()
+        self.assertFalse(os.path.exists(dst))
+        ### Bad copies are named after their checksum, the same copy is kept once
+        checksum = hashlib.sha1(b'foo-x86_64').hexdigest()[:16]
+        self.assertEqual(os.listdir(os.path.join(self.tmpdir, 'quarantine')), ['foo.rpm.part.' + checksum])
+
+    def test_fetchsegmented(self):
+        import hashlib
+        mrepo.cf.httpsegmentsize = 3
+        dst = os.path.join(self.tmpdir, 'foo.rpm')
+        urls = [self.url + 'Packages/foo-1.0-1.x86_64.rpm', self.url + 'missing/foo-1.0-1.x86_64.rpm']
+        checksum = hashlib.sha256(b'foo-x86_64').hexdigest()
+        pool = mrepo.HTTPPool(timeout=10)
+        self.assertEqual(mrepo.fetchsegmented(pool, urls, dst, 10, 'sha256', checksum), None)
+        self.assertEqual(open(dst).read(), 'foo-x86_64')
+        self.assertFalse(os.path.exists(dst + '.part'))
+
+        # only the segments that are not done yet are fetched again
+        os.unlink(dst)
+        open(dst + '.part', 'w').write('XXX-x86_64')
+        open(dst + '.part.segments', 'w').write('3 3\n6 3\n9 1\n')
+        self.assertEqual(mrepo.fetchsegmented(pool, urls, dst, 10, 'sha256', checksum), None)
+        self.assertEqual(open(dst).read(), 'foo-x86_64')
+        self.assertFalse(os.path.exists(dst + '.part.segments'))
+
+        # a log of other segments is discarded and the whole file fetched again
+        os.unlink(dst)
+        open(dst + '.part', 'w').write('XXX-x86_64')
+        for segments in ('3 2\n6 3\n', '2 2\n', '3\n6\n'):
+            open(dst + '.part.segments', 'w').write(segments)
+            self.assertTrue(mrepo.fetchsegmented(pool, urls[1:], dst, 10, 'sha256', checksum))
+            self.assertEqual(open(dst + '.part.segments').read(), '')
+        self.assertEqual(mrepo.fetchsegmented(pool, urls, dst, 10, 'sha256', checksum), None)
+        self.assertEqual(open(dst).read(), 'foo-x86_64')
+
+        # a log without its partial download is started over
+        os.unlink(dst)
+        open(dst + '.part.segments', 'w').write('3\n6\n')
+        self.assertTrue(mrepo.fetchsegmented(pool, urls[1:], dst, 10, 'sha256', checksum))
+        self.assertEqual(open(dst + '.part.segments').read(), '')
+        pool.close()
+
+    def test_fetchconnections(self):
+        import hashlib
+        mrepo.cf.httpsegmentsize = 2
+        dst = os.path.join(self.tmpdir, 'foo.rpm')
+        checksum = hashlib.sha256(b'foo-x86_64').hexdigest()
+        ### Segments only take the connections the pool has to spare, and give them back
+        for connections in (0, 3):
+            pool = mrepo.HTTPPool(timeout=10, connections=connections)
+            self.assertEqual(mrepo.fetchsegmented(pool, [self.url + 'Packages/foo-1.0-1.x86_64.rpm'], dst, 10, 'sha256', checksum), None)
+            self.assertEqual(open(dst).read(), 'foo-x86_64')
+            self.assertEqual(sum([pool.slots.acquire(blocking=False) for i in range(4)]), connections)
+            pool.close()
+            os.unlink(dst)
+
+    def test_segmentmirrors(self):
+        mrepo.cf.httpsegmentsize = 3
+        mirror = os.path.join(self.updir, 'mirror')
+        os.makedirs(os.path.join(mirror, 'repodata'))
+        os.makedirs(os.path.join(mirror, 'Packages'))
+        ### The mirror has another build of foo, its segments do not fit
+        open(os.path.join(mirror, 'Packages', 'foo-1.0-1.x86_64.rpm'), 'w').write('BAR-X86-64')
+        open(os.path.join(mirror, 'repodata', 'primary.xml'), 'w').write(
+            '<metadata xmlns="http://linux.duke.edu/metadata/common" packages="1"><package type="rpm">'
+            '<name>foo</name><arch>x86_64</arch><checksum type="sha256">%s</checksum>'
+            '<size package="10"/><location href="Packages/foo-1.0-1.x86_64.rpm"/></package></metadata>\n' % ('0' * 64))
+        open(os.path.join(mirror, 'repodata', 'repomd.xml'), 'w').write(
+            '<repomd xmlns="http://linux.duke.edu/metadata/repo"><data type="primary">'
+            '<location href="repodata/primary.xml"/></data></repomd>\n')
+        mrepo.mirrorhttp(self.url, self.srcdir, None, mirrors=[self.url + 'mirror/'])
+        self.assertEqual(open(os.path.join(self.srcdir, 'Packages', 'foo-1.0-1.x86_64.rpm')).read(), 'foo-x86_64')
+
+    def test_parsechecksums(self):
+        text = ('# comment\n%s  disc1.iso\n%s *sub/disc2.iso\nSHA256 (disc3.iso) = %s\n'
+                % ('a' * 64, 'b' * 40, 'C' * 64))
+        self.assertEqual(mrepo.parsechecksums(text), {'disc1.iso': ('sha256', 'a' * 64),
+                                                      'disc2.iso': ('sha1', 'b' * 40),
+                                                      'disc3.iso': ('sha256', 'c' * 64)})
+
+    def test_fetchisos(self):
+        import hashlib
+        isodir = os.path.join(self.updir, 'isos')
+        os.makedirs(isodir)
+        sums = ''
+        for name in ('disc1.iso', 'disc2.iso', 'boot.iso'):
+            open(os.path.join(isodir, name), 'w').write(name * 100)
+            sums += '%s  %s\n' % (hashlib.sha256((name * 100).encode()).hexdigest(), name)
+        open(os.path.join(isodir, 'SHA256SUMS'), 'w').write(sums)
+
+        pool = mrepo.HTTPPool(timeout=10)
+        isos = mrepo.listisos(pool, self.url + 'isos/disc?.iso')
+        self.assertEqual([iso[:3] for iso in isos], [(self.url + 'isos/disc1.iso', 'disc1.iso', 'sha256'),
+                                                     (self.url + 'isos/disc2.iso', 'disc2.iso', 'sha256')])
+        self.assertEqual(len(mrepo.listisos(pool, self.url + 'isos/SHA256SUMS')), 3)
+        pool.close()
+
+        dist = mrepo.Dist('test', 'i386', mrepo.cf)
+        dist.iso = self.url + 'isos/disc?.iso'
+        dist.fetchisos()
+        self.assertEqual(sorted(os.listdir(os.path.join(self.srcdir, 'test-i386'))), ['disc1.iso', 'disc2.iso'])
+
+        # a corrupt ISO is verified against its checksum and downloaded again
+        open(os.path.join(self.srcdir, 'test-i386', 'disc2.iso'), 'w').write('corrupt')
+        dist.fetchisos()
+        self.assertEqual(open(os.path.join(self.srcdir, 'test-i386', 'disc2.iso')).read(), 'disc2.iso' * 100)
+        dist.findisos()
+        self.assertEqual(len(dist.isos), 2)
+
+        ### ISO files listed in a checksum file are found by their names
+        dist = mrepo.Dist('test', 'i386', mrepo.cf)
+        dist.iso = self.url + 'isos/SHA256SUMS'
+        dist.fetchisos()
+        dist.findisos()
+        self.assertEqual([os.path.basename(iso) for iso in dist.isos], ['boot.iso', 'disc1.iso', 'disc2.iso'])
+
+    def test_selectmirrors(self):
+        for name, revision in (('stale', 100), ('fresh', 200)):
+            os.makedirs(os.path.join(self.updir, name, 'repodata'))
+            open(os.path.join(self.updir, name, 'repodata', 'repomd.xml'), 'w').write(
+                '<repomd xmlns="http://linux.duke.edu/metadata/repo"><revision>%d</revision></repomd>\n' % revision)
+        stale, fresh, dead = self.url + 'stale/', self.url + 'fresh/', self.url + 'dead/'
+        self.assertEqual(mrepo.selectmirrors([dead, stale, fresh], None), [fresh, stale, dead])
+
+        open(os.path.join(self.updir, 'mirrorlist'), 'w').write('# mirrors\n%s\n%s\n' % (stale, fresh))
+        self.assertEqual(mrepo.expandmirrors('mirrorlist+' + self.url + 'mirrorlist', None), [stale, fresh])
+        open(os.path.join(self.updir, 'metalink'), 'w').write(
+            '<metalink xmlns="http://www.metalinker.org/"><files><file name="repomd.xml"><resources>'
+            '<url protocol="http">%srepodata/repomd.xml</url></resources></file></files></metalink>\n' % fresh)
+        self.assertEqual(mrepo.expandmirrors('metalink+' + self.url + 'metalink', None), [fresh])
+
+    def test_mirrorstats(self):
+        filename = os.path.join(self.tmpdir, 'mirrors.json')
+        stats = mrepo.MirrorStats(filename)
+        stats.record('http://slow.example.com/', latency=0.5, throughput=100000)
+        stats.record('http://fast.example.com', latency=0.1, throughput=10000000)
+        stats.record('http://broken.example.com', latency=0.1, throughput=10000000)
+        stats.record('http://broken.example.com', failed=True)
+        stats.save()
+        stats = mrepo.MirrorStats(filename)
+        urls = ['http://slow.example.com', 'http://broken.example.com', 'http://fast.example.com/']
+        self.assertEqual(sorted(urls, key=stats.score), ['http://fast.example.com/', 'http://broken.example.com', 'http://slow.example.com'])
+
+    def test_mdprimary(self):
+        pool = mrepo.HTTPPool(timeout=10)
+        packages = mrepo.mdprimary(pool, self.url)
+        self.assertEqual([(p[0], p[1], p[4], p[5]) for p in packages],
+                         [('Packages/foo-1.0-1.x86_64.rpm', 10, 'foo', 'x86_64'),
+                          ('Packages/foo-debuginfo-1.0-1.x86_64.rpm', 20, 'foo-debuginfo', 'x86_64'),
+                          ('Packages/foo-1.0-1.src.rpm', 7, 'foo', 'src')])
+        self.assertEqual(mrepo.mdprimary(pool, self.url + 'missing/'), None)
+        pool.close()
+
+    def test_probeupstream(self):
+        state = mrepo.probeupstream(self.url, {}, None)
+        self.assertTrue(state['checksum'])
+        self.assertEqual(mrepo.probeupstream(self.url, state, None), state)
+        self.assertEqual(mrepo.probeupstream(self.url, dict(state, etag=None, modified=None), None)['checksum'], state['checksum'])
+        open(os.path.join(self.updir, 'repodata', 'repomd.xml'), 'a').write('\n')
+        os.utime(os.path.join(self.updir, 'repodata', 'repomd.xml'), (2000000000, 2000000000))
+        self.assertNotEqual(mrepo.probeupstream(self.url, state, None)['checksum'], state['checksum'])
+        self.assertEqual(mrepo.probeupstream(self.url + 'missing/', {}, None), None)
+
 class Testlinksync(unittest.TestCase):
     def setUp(self):
         mkdir = os.mkdir
@@ -158,28 +1313,13 @@ class Testlinksync(unittest.TestCase):
 
         
     def tearDown(self):
-        isdir = os.path.isdir
-        walk = os.path.walk
-        pathjoin= os.path.join
+        import shutil
         tmpdir = self.tmpdir
         # for safety-reasons:
         if tmpdir.count('/') < 3:
-            raise "Will not remove tmpdir %s" % ( tmpdir, )
-
-        def rmfile(arg, path, files):
-            for file in files:
-                # print "%s" % ( file, )
-                f = pathjoin(path, file)
-                if isdir(f):
-                    walk(f, rmfile, None)
-                    #print "rmdir %s" % ( f, )
-                    os.rmdir(f)
-                else:
-                    #print "unlink %s" % ( f, )
-                    os.unlink(f)
+            raise Exception("Will not remove tmpdir %s" % ( tmpdir, ))
 
-        os.path.walk(tmpdir, rmfile, None)
-        os.rmdir(tmpdir)
+        shutil.rmtree(tmpdir)
 
     def readlinks(self, dir):
         """return a list of (linkname, linktarget) tuples for all files in a directory"""
@@ -209,6 +1349,19 @@ class Testlinksync(unittest.TestCase):
             ]
         self.assertEqual(actual, target)
 
+    def test_walkrpms(self):
+        srcdir = self.repo.srcdir
+        actual = [(name, path) for name, path, size, mtime in mrepo.walkrpms(srcdir)]
+        target = [
+            ('0.rpm', srcdir),
+            ('1.rpm', srcdir),
+            ('2.rpm', srcdir),
+            ('3.rpm', srcdir),
+            ('2.rpm', os.path.join(srcdir, 'a')),
+            ('a.rpm', os.path.join(srcdir, 'a')),
+            ]
+        self.assertEqual(actual, target)
+
     def test_listrpms_rel(self):
         srcdir = self.repo.srcdir
         linkbase = self.linkbase
@@ -229,6 +1382,7 @@ class Testlinksync(unittest.TestCase):
         self.dist.linksync(repo)
 
         actual = self.readlinks(repo.wwwdir)
+        actual.sort()
         target = self.links
         self.assertEqual(actual, target)
 
@@ -289,6 +1443,62 @@ class Testlinksync(unittest.TestCase):
         actual.sort()
         target = self.links
         self.assertEqual(actual, target)
+        # changed links are replaced through a temporary link, none is left behind
+        self.assertEqual([name for name in os.listdir(repo.wwwdir) if name.startswith('.')], [])
+
+    def test_genrepo_failure(self):
+        # a failing repository is reported through its exitcode and releases its lock
+        class LockConfig:
+            lockdir = os.path.join(self.tmpdir, 'lock')
+        def fail(repo, srcdirs=None):
+            raise OSError('disk on fire')
+        oldcf = getattr(mrepo, 'cf', None)
+        mrepo.cf = LockConfig()
+        self.dist.linksync = fail
+        try:
+            self.assertEqual(self.dist.genrepo(self.repo), None)
+        finally:
+            mrepo.cf = oldcf
+        self.assertEqual(self.repo.exitcode, 2)
+        self.assertEqual(os.listdir(os.path.join(self.tmpdir, 'lock', 'testdist-i386')), [])
+
+    def test_genall_failure(self):
+        # RPMS.all keeps the links of a repository that failed to generate
+        class LockConfig:
+            lockdir = os.path.join(self.tmpdir, 'lock')
+        def fail(repo, srcdirs=None):
+            raise OSError('disk on fire')
+        allrepo = mrepo.Repo('all', '', self.dist, self.cf)
+        os.makedirs(allrepo.wwwdir)
+        self.dist.linksync(allrepo, [self.repo.srcdir])
+        oldcf = getattr(mrepo, 'cf', None)
+        mrepo.cf = LockConfig()
+        self.dist.linksync = fail
+        try:
+            srcdirs = self.dist.genrepo(self.repo)
+            del self.dist.linksync
+            self.assertTrue(self.dist.genall([srcdirs, []]))
+        finally:
+            mrepo.cf = oldcf
+        actual = self.readlinks(allrepo.wwwdir)
+        actual.sort()
+        self.assertEqual([name for name, target in actual], [name for name, target in self.links])
+
+    def test_synclinks_replace(self):
+        # a changed link is renamed over the old one, never removed first
+        os.symlink('old.rpm', os.path.join(self.repo.wwwdir, 'a.rpm'))
+        unlinked = []
+        unlink = mrepo.os.unlink
+        def trackunlink(path, *args, **kwargs):
+            unlinked.append(path)
+            return unlink(path, *args, **kwargs)
+        mrepo.os.unlink = trackunlink
+        try:
+            mrepo.synclinks(self.repo.wwwdir, [], [('a.rpm', 'new.rpm')])
+        finally:
+            mrepo.os.unlink = unlink
+        self.assertFalse('a.rpm' in unlinked)
+        self.assertEqual(os.readlink(os.path.join(self.repo.wwwdir, 'a.rpm')), 'new.rpm')
 
 
     def test_linksync_mod(self):